@@ -1,12 +1,33 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from PIL import Image
+from pypdf import PdfReader, PdfWriter
 import os
+import sys
 import io
+import re
 import shutil  # Para el chequeo de dependencias
-import pytesseract
-from pdf2image import convert_from_bytes
-from pdf2docx import Converter
-from docx import Document
+import hashlib
+import time
+import threading
+import queue
+import heapq
+import tempfile
+import subprocess
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+import importlib
+import logging
+from xml.sax.saxutils import escape
+from converters import convert_digital_chunk
+
+# Cada página ya se procesa en su propio hilo/proceso: se desactiva el multihilo
+# interno (OpenMP) de Tesseract para que los hilos no compitan por los núcleos.
+# Debe fijarse antes de cargar la librería de Tesseract.
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+# Motor LSTM (--oem 1) y bloque de texto uniforme (--psm 6): la receta rápida por página
+TESSERACT_CONFIG = "--oem 1 --psm 6"
 
 # --- 0. Configuración de la Página y Logos ---
 
@@ -16,11 +37,17 @@ st.set_page_config(
     layout="wide"
 )
 
-# Cargar logos (poner en carpeta 'logos/')
-try:
-    logo_izq = Image.open("logos/logo1.png")
-except FileNotFoundError:
-    logo_izq = None
+# Cargar logos (poner en carpeta 'logos/'). Se leen una sola vez, no en cada rerun.
+@st.cache_resource
+def load_logo(path):
+    try:
+        logo = Image.open(path)
+        logo.load()
+        return logo
+    except FileNotFoundError:
+        return None
+
+logo_izq = load_logo("logos/logo1.png")
 
 # Título y Logos
 col1, col2, col3 = st.columns([1, 3, 1])
@@ -35,9 +62,21 @@ st.markdown("---")
 
 # --- 1. Chequeo de Dependencias del Sistema ---
 
+@st.cache_resource
+def system_deps():
+    """Busca los programas externos en el PATH una sola vez (no en cada rerun)."""
+    return {
+        "tesseract": shutil.which("tesseract") is not None,
+        "poppler": shutil.which("pdftoppm") is not None,  # Opcional: pdftoppm/pdfinfo son parte de Poppler
+        # Opcional: acelera el OCR. Necesita Ghostscript ('gs') para funcionar.
+        "ocrmypdf": shutil.which("ocrmypdf") is not None and shutil.which("gs") is not None,
+    }
+
 st.sidebar.header("Estado del Sistema (OCR)")
-tesseract_ok = shutil.which("tesseract") is not None
-poppler_ok = shutil.which("pdftoppm") is not None  # pdftoppm es parte de Poppler
+deps = system_deps()
+tesseract_ok = deps["tesseract"]
+poppler_ok = deps["poppler"]
+ocrmypdf_ok = deps["ocrmypdf"]
 
 if tesseract_ok:
     st.sidebar.success("Tesseract (OCR) detectado.")
@@ -48,157 +87,693 @@ else:
 if poppler_ok:
     st.sidebar.success("Poppler (PDF) detectado.")
 else:
-    st.sidebar.error("Poppler NO encontrado.")
-    st.sidebar.info("Instala Poppler en tu sistema para habilitar la conversión de PDFs escaneados.")
+    st.sidebar.info("Poppler no encontrado (opcional). Las páginas se renderizan con PDFium.")
+
+if ocrmypdf_ok:
+    st.sidebar.success("OCRmyPDF detectado (OCR acelerado).")
+else:
+    st.sidebar.info("OCRmyPDF (o Ghostscript) no encontrado (opcional). Se usará el OCR integrado.")
+
+st.sidebar.caption(
+    "El OCR procesa varias páginas en paralelo (una por núcleo), por eso se limita "
+    "Tesseract a un hilo por página (OMP_THREAD_LIMIT=1): así los hilos no compiten entre sí."
+)
 
 # --- 2. Opciones de Conversión (Sidebar) ---
 
 st.sidebar.header("Opciones de Conversión")
 
 # Usamos 'disabled' para bloquear la opción OCR si falta el software
-ocr_disabled = not (tesseract_ok and poppler_ok)
+ocr_disabled = not tesseract_ok
 if ocr_disabled:
     st.sidebar.warning("Modo OCR deshabilitado. Ver 'Estado del Sistema'.")
 
 # Selección de modo
 modo_conversion = st.sidebar.radio(
     "Selecciona el tipo de PDF:",
-    options=["Digital (Formato perfecto, rápido)", "Escaneado (OCR, más lento)"],
+    options=[
+        "Digital (Formato perfecto, rápido)",
+        "Escaneado (OCR, más lento)",
+        "Mixto (auto-detecta cada página)",
+    ],
     index=0,
     disabled=ocr_disabled
 )
 
 # Opciones específicas de OCR
 lang = "spa" # Idioma por defecto
-if "Escaneado" in modo_conversion:
+skip_text = False
+if "Escaneado" in modo_conversion or "Mixto" in modo_conversion:
     st.sidebar.markdown("### Opciones de OCR")
     # Puedes añadir más idiomas si los instalaste con Tesseract
     lang = st.sidebar.selectbox("Idioma del documento:", ["spa", "eng"], help="'spa' = Español, 'eng' = Inglés")
+if "Escaneado" in modo_conversion:
+    skip_text = st.sidebar.checkbox(
+        "Saltar OCR si hay texto embebido",
+        value=True,
+        help="Las páginas que ya tienen una capa de texto se copian directamente, sin OCR."
+    )
 
 # --- 3. Funciones de Conversión ---
 
+# Las librerías de conversión (pdf2docx, pypdfium2, pytesseract, python-docx...)
+# se importan dentro de las funciones que las usan: solo se cargan al convertir,
+# no en cada rerun de la interfaz.
+
+# Un elemento del rango: "3" o "3-5", seguido de una coma o del final del texto
+PAGE_RANGE_RE = re.compile(r"\s*(\d+)\s*(?:-\s*(\d+))?\s*(?:,|$)")
+
 def parse_page_range(range_str, max_pages):
     """Convierte un string como '1, 3-5' en una lista [0, 2, 3, 4]"""
-    if not range_str:
+    if not range_str or not range_str.strip():
         return list(range(max_pages))  # Todas las páginas
-    
-    pages = set()
-    try:
-        parts = range_str.split(',')
-        for part in parts:
-            if '-' in part:
-                start, end = map(int, part.split('-'))
-                if start > 0 and end <= max_pages and start <= end:
-                    pages.update(range(start - 1, end)) # Zero-indexed
-            else:
-                page = int(part)
-                if page > 0 and page <= max_pages:
-                    pages.add(page - 1) # Zero-indexed
-        return sorted(list(pages))
-    except Exception:
-        st.error("Rango de páginas inválido. Usando todas las páginas.")
-        return list(range(max_pages))
 
-def convert_digital(pdf_bytes, pages_to_convert):
-    """Usa pdf2docx para conversión de alta fidelidad."""
-    pdf_stream = io.BytesIO(pdf_bytes)
+    # Un byte por página: marca las seleccionadas sin set ni ordenación,
+    # y los rangos solapados se deduplican solos
+    bitmap = bytearray(max_pages)
+    pos = 0
+    while pos < len(range_str):
+        match = PAGE_RANGE_RE.match(range_str, pos)
+        if match is None:
+            st.error("Rango de páginas inválido. Usando todas las páginas.")
+            return list(range(max_pages))
+        start = int(match[1])
+        end = int(match[2] or start)
+        if 0 < start <= end <= max_pages:
+            bitmap[start - 1:end] = b"\x01" * (end - start + 1)  # Zero-indexed
+        pos = match.end()
+    return [i for i, selected in enumerate(bitmap) if selected]
+
+def append_docx(master, docx_bytes):
+    """Añade el cuerpo de un .docx al final de 'master', copiando sus imágenes y enlaces.
+    La última sección de 'master' se cierra con un salto de sección para conservar
+    el tamaño de página de cada parte."""
+    from docx import Document
+    from docx.oxml import OxmlElement
+    from docx.oxml.ns import qn
+    from docx.opc.constants import RELATIONSHIP_TYPE as RT
+
+    # Atributos de relación que pueden aparecer en el cuerpo de un .docx de pdf2docx
+    rel_attrs = [qn("r:embed"), qn("r:id"), qn("r:link")]
+    source = Document(io.BytesIO(docx_bytes))
+    body = master.element.body
+
+    # El sectPr final de 'master' pasa a un párrafo vacío (salto de sección)
+    sect_pr = body.sectPr
+    body.remove(sect_pr)
+    p = OxmlElement("w:p")
+    p_pr = OxmlElement("w:pPr")
+    p_pr.append(sect_pr)
+    p.append(p_pr)
+    body.append(p)
+
+    for element in list(source.element.body):
+        # Las relaciones (rId) son propias de cada documento: hay que recrearlas en 'master'
+        for node in element.iter():
+            for attr in rel_attrs:
+                r_id = node.get(attr)
+                if r_id is None or r_id not in source.part.rels:
+                    continue
+                rel = source.part.rels[r_id]
+                if rel.is_external:
+                    new_id = master.part.relate_to(rel.target_ref, rel.reltype, is_external=True)
+                elif rel.reltype == RT.IMAGE:
+                    new_id, _ = master.part.get_or_add_image(io.BytesIO(rel.target_part.blob))
+                else:
+                    continue
+                node.set(attr, new_id)
+        body.append(element)  # Incluye el sectPr final del documento añadido
+
+# Script que convierte un grupo de páginas en un proceso aparte
+CONVERTERS_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "converters.py")
+# Páginas mínimas por proceso para que compense arrancarlo
+MIN_PAGES_PER_PROCESS = 4
+
+# Las conversiones se cachean por hash del PDF + opciones: los reruns de
+# Streamlit con el mismo archivo devuelven el resultado sin volver a convertir.
+# '_pdf_path' empieza por '_' para que Streamlit no lo use en la clave de caché.
+@st.cache_data(show_spinner=False, max_entries=8, ttl=3600)
+def convert_digital(_pdf_path, pdf_hash, pages_to_convert):
+    """Usa pdf2docx para conversión de alta fidelidad. En documentos grandes reparte
+    las páginas entre un proceso por núcleo y une los resultados en orden."""
+    from docx import Document
+
+    # Lanzar un proceso cuesta importar pdf2docx de nuevo: solo compensa
+    # con varias páginas por proceso
+    workers = min(os.cpu_count() or 1, len(pages_to_convert) // MIN_PAGES_PER_PROCESS)
+    if workers <= 1:
+        docx_stream = io.BytesIO()
+        convert_digital_chunk(_pdf_path, docx_stream, pages_to_convert)
+        return docx_stream.getvalue()
+
+    # Grupos contiguos de tamaño similar, uno por proceso. Cada proceso es un
+    # intérprete nuevo que ejecuta converters.py: no se hace 'fork' del servidor
+    # de Streamlit (multihilo) ni se serializan funciones de este script.
+    size = -(-len(pages_to_convert) // workers)
+    chunks = [pages_to_convert[i:i + size] for i in range(0, len(pages_to_convert), size)]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        def run_chunk(i):
+            docx_path = os.path.join(tmp_dir, f"parte{i}.docx")
+            result = subprocess.run(
+                [sys.executable, CONVERTERS_SCRIPT, _pdf_path, docx_path, ",".join(map(str, chunks[i]))],
+                capture_output=True,
+                text=True,
+            )
+            if result.returncode != 0:
+                raise RuntimeError(f"pdf2docx falló: {result.stderr.strip()[-500:]}")
+            with open(docx_path, "rb") as f:
+                return f.read()
+
+        with ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+            parts = list(executor.map(run_chunk, range(len(chunks))))
+
+    doc = Document(io.BytesIO(parts[0]))
+    for part in parts[1:]:
+        append_docx(doc, part)
     docx_stream = io.BytesIO()
-    
-    cv = Converter(pdf_stream)
-    # Convierte solo las páginas seleccionadas
-    cv.convert(docx_stream, pages=pages_to_convert)
-    cv.close()
-    
+    doc.save(docx_stream)
     return docx_stream.getvalue()
 
-def convert_ocr(pdf_bytes, lang_code, pages_to_convert):
-    """Usa Tesseract OCR para convertir imágenes de PDF a texto."""
-    st.info(f"Usando OCR en idioma: {lang_code}. Esto tomará un momento...")
-    
-    # 1. Convertir páginas de PDF a imágenes
-    # El 'pages_to_convert' aquí es 1-indexed para poppler, así que sumamos 1
-    pages_1_indexed = [p + 1 for p in pages_to_convert]
-    images = convert_from_bytes(
-        pdf_bytes,
-        fmt="jpeg",
-        thread_count=4,
-        first_page=min(pages_1_indexed),
-        last_page=max(pages_1_indexed)
+# Inclinación máxima (en grados) que se corrige; por encima se deja la página como está
+MAX_DESKEW_ANGLE = 10
+
+def preprocess_page(img):
+    """Binariza la página (Otsu) y corrige su inclinación. Devuelve un array uint8 (un canal)."""
+    import cv2
+    import numpy as np
+
+    gray = np.asarray(img.convert("L"))
+    _, bw = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+
+    # Inclinación estimada por líneas de texto: se unen los caracteres de cada
+    # línea en un bloque horizontal y se toma la mediana de sus ángulos. Así
+    # no influyen la disposición de la página ni trazos sueltos (firmas, sellos).
+    h, w = bw.shape
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (max(w // 50, 1), 1))
+    blocks = cv2.dilate(255 - bw, kernel)
+    contours, _ = cv2.findContours(blocks, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    angles = []
+    for contour in contours:
+        _, (rect_w, rect_h), angle = cv2.minAreaRect(contour)
+        long_side, short_side = max(rect_w, rect_h), min(rect_w, rect_h)
+        # Solo bloques alargados y anchos: líneas de texto, no manchas ni letras sueltas
+        if long_side < w / 10 or long_side < 5 * short_side:
+            continue
+        while angle > 45:
+            angle -= 90
+        while angle <= -45:
+            angle += 90
+        angles.append(angle)
+    if not angles:
+        return bw
+    angle = float(np.median(angles))
+    # Ángulos pequeños no compensan el giro; los grandes no son inclinación de escaneo
+    if abs(angle) < 0.1 or abs(angle) > MAX_DESKEW_ANGLE:
+        return bw
+
+    matrix = cv2.getRotationMatrix2D((w / 2, h / 2), angle, 1.0)
+    return cv2.warpAffine(bw, matrix, (w, h), flags=cv2.INTER_NEAREST, borderValue=255)
+
+def optional_import(name):
+    """Importa un módulo opcional. Devuelve None si no está instalado."""
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
+
+@st.cache_resource
+def pdfium_lock():
+    """Cerrojo único para todo el proceso: PDFium no admite llamadas simultáneas
+    desde varios hilos, ni siquiera sobre documentos distintos, y cada sesión de
+    Streamlit convierte en su propio hilo."""
+    return threading.Lock()
+
+def ocr_pages(pdf_path, lang_code, pages_1_indexed):
+    """Renderiza y aplica OCR en tubería: un hilo productor renderiza las páginas
+    una a una hacia una cola acotada y un hilo de OCR por núcleo las consume.
+    Devuelve una lista de (página, texto) ordenada por página."""
+    import pytesseract
+    import pypdfium2 as pdfium
+
+    # tesserocr mantiene Tesseract cargado en el mismo proceso (mucho más rápido
+    # que pytesseract, que lanza un subproceso por página). Es opcional.
+    tesserocr = optional_import("tesserocr")
+    # OpenCV (opcional) binariza y endereza las páginas antes del OCR, con
+    # operaciones vectorizadas mucho más rápidas que el preprocesado de Tesseract.
+    opencv_ok = optional_import("cv2") is not None
+
+    workers = os.cpu_count() or 1
+    # La cola acotada limita las imágenes en memoria a la vez
+    q = queue.Queue(maxsize=2 * workers)
+    results = []  # heap de (página, texto)
+    errors = []
+    lock = threading.Lock()
+    pdfium_guard = pdfium_lock()
+
+    def render():
+        # PDFium renderiza en el mismo proceso (sin lanzar pdftoppm por página) y
+        # solo las páginas pedidas. Es secuencial: el paralelismo está en el OCR.
+        # Toda llamada a PDFium va dentro del cerrojo global.
+        pdf = None
+        try:
+            with pdfium_guard:
+                pdf = pdfium.PdfDocument(pdf_path)
+            for page_num in pages_1_indexed:
+                if errors:
+                    break
+                with pdfium_guard:
+                    # 200 DPI en escala de grises: un solo canal, que pasa directo a
+                    # Tesseract sin conversión de color
+                    page = pdf[page_num - 1]
+                    bitmap = page.render(scale=200 / 72, grayscale=True)
+                    # Copia propia de la imagen: el bitmap se libera aquí, no en
+                    # otro hilo cuando lo recoja el recolector de basura
+                    img = bitmap.to_pil().copy()
+                    bitmap.close()
+                    page.close()
+                q.put((page_num, img))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            if pdf is not None:
+                with pdfium_guard:
+                    pdf.close()
+            for _ in range(workers):
+                q.put(None)  # Una señal de fin por cada hilo de OCR
+
+    def ocr_worker():
+        # Una instancia de Tesseract por hilo: el modelo se carga una vez por hilo
+        # y tesserocr libera el GIL durante el reconocimiento.
+        api = None
+        while True:
+            item = q.get()
+            try:
+                if item is None:
+                    break
+                if errors:
+                    continue  # Tras un error solo vaciamos la cola
+                page_num, img = item
+                if opencv_ok:
+                    img = preprocess_page(img)
+                if tesserocr is not None:
+                    if api is None:
+                        api = tesserocr.PyTessBaseAPI(
+                            lang=lang_code,
+                            psm=tesserocr.PSM.SINGLE_BLOCK,
+                            oem=tesserocr.OEM.LSTM_ONLY
+                        )
+                    if opencv_ok:
+                        # Bytes crudos de 8 bits: sin volver a codificar la imagen
+                        h, w = img.shape
+                        api.SetImageBytes(img.tobytes(), w, h, 1, w)
+                    else:
+                        api.SetImage(img)
+                    text = api.GetUTF8Text()
+                else:
+                    text = pytesseract.image_to_string(img, lang=lang_code, config=TESSERACT_CONFIG)
+                with lock:
+                    heapq.heappush(results, (page_num, text))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                q.task_done()
+        if api is not None:
+            api.End()
+
+    threads = [threading.Thread(target=render)]
+    threads += [threading.Thread(target=ocr_worker) for _ in range(workers)]
+    for t in threads:
+        t.start()
+    q.join()
+    for t in threads:
+        t.join()
+
+    if errors:
+        raise errors[0]
+    return [heapq.heappop(results) for _ in range(len(results))]
+
+def ocr_pages_ocrmypdf(pdf_path, lang_code, pages_1_indexed):
+    """Aplica OCR con ocrmypdf (un solo proceso nativo y multihilo) a las páginas
+    indicadas y lee el texto del archivo 'sidecar'. Devuelve una lista de (página, texto)."""
+    # Solo se pasan a ocrmypdf las páginas seleccionadas
+    reader = PdfReader(pdf_path)
+    writer = PdfWriter()
+    for page_num in pages_1_indexed:
+        writer.add_page(reader.pages[page_num - 1])
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        in_path = os.path.join(tmp_dir, "entrada.pdf")
+        out_path = os.path.join(tmp_dir, "salida.pdf")
+        sidecar_path = os.path.join(tmp_dir, "texto.txt")
+        writer.write(in_path)
+        result = subprocess.run(
+            [
+                "ocrmypdf",
+                # Aquí solo llegan páginas sin capa de texto útil, aunque puedan tener
+                # un texto corto (número de página, sello): siempre se aplica OCR
+                "--force-ocr",
+                "--jobs", str(os.cpu_count() or 1),
+                "--language", lang_code,
+                "--tesseract-oem", "1",
+                "--tesseract-pagesegmode", "6",
+                # Solo nos interesa el texto: sin conversión a PDF/A ni optimización
+                "--output-type", "pdf",
+                "--optimize", "0",
+                "--sidecar", sidecar_path,
+                "--quiet",
+                in_path,
+                out_path,
+            ],
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode != 0:
+            raise RuntimeError(f"ocrmypdf falló: {result.stderr.strip()}")
+
+        # El sidecar separa las páginas con un salto de página ('\f')
+        with open(sidecar_path, encoding="utf-8") as f:
+            texts = f.read().split("\f")
+        if len(texts) < len(pages_1_indexed):
+            raise RuntimeError(f"ocrmypdf devolvió texto para {len(texts)} de {len(pages_1_indexed)} páginas.")
+        return list(zip(pages_1_indexed, texts))
+
+# Mínimo de caracteres para considerar que una página ya tiene capa de texto
+# suficiente como para copiarla en lugar de aplicarle OCR ("Saltar OCR si hay texto embebido")
+MIN_EMBEDDED_CHARS = 80
+
+def embedded_texts(pdf_path, pages_to_convert, min_chars=MIN_EMBEDDED_CHARS):
+    """Devuelve {página (1-indexed): texto} de las páginas cuyo texto embebido
+    tiene más de 'min_chars' caracteres."""
+    reader = PdfReader(pdf_path)
+    texts = {}
+    for p in pages_to_convert:
+        text = reader.pages[p].extract_text() or ""
+        if len(text.strip()) > min_chars:
+            texts[p + 1] = text
+    return texts
+
+# Partes fijas de un .docx mínimo para el resultado del OCR (estilos Title y Heading3)
+DOCX_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+    '<Override PartName="/word/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.styles+xml"/>'
+    '</Types>'
+)
+DOCX_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/>'
+    '</Relationships>'
+)
+DOCX_DOCUMENT_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>'
+    '</Relationships>'
+)
+DOCX_STYLES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<w:styles xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+    '<w:docDefaults>'
+    '<w:rPrDefault><w:rPr><w:rFonts w:ascii="Calibri" w:hAnsi="Calibri" w:eastAsia="Calibri" w:cs="Calibri"/>'
+    '<w:sz w:val="22"/><w:szCs w:val="22"/></w:rPr></w:rPrDefault>'
+    '<w:pPrDefault><w:pPr><w:spacing w:after="200" w:line="276" w:lineRule="auto"/></w:pPr></w:pPrDefault>'
+    '</w:docDefaults>'
+    '<w:style w:type="paragraph" w:default="1" w:styleId="Normal"><w:name w:val="Normal"/><w:qFormat/></w:style>'
+    '<w:style w:type="paragraph" w:styleId="Title"><w:name w:val="Title"/><w:basedOn w:val="Normal"/>'
+    '<w:next w:val="Normal"/><w:qFormat/><w:pPr><w:spacing w:after="300"/></w:pPr>'
+    '<w:rPr><w:color w:val="17365D"/><w:sz w:val="52"/><w:szCs w:val="52"/></w:rPr></w:style>'
+    '<w:style w:type="paragraph" w:styleId="Heading3"><w:name w:val="heading 3"/><w:basedOn w:val="Normal"/>'
+    '<w:next w:val="Normal"/><w:qFormat/><w:pPr><w:keepNext/><w:spacing w:before="200" w:after="0"/>'
+    '<w:outlineLvl w:val="2"/></w:pPr><w:rPr><w:b/><w:color w:val="4F81BD"/></w:rPr></w:style>'
+    '</w:styles>'
+)
+DOCX_DOCUMENT_HEAD = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>'
+)
+DOCX_DOCUMENT_TAIL = (
+    '<w:sectPr><w:pgSz w:w="12240" w:h="15840"/>'
+    '<w:pgMar w:top="1440" w:right="1800" w:bottom="1440" w:left="1800" w:header="720" w:footer="720" w:gutter="0"/>'
+    '</w:sectPr></w:body></w:document>'
+)
+
+# Caracteres de control no válidos en XML (Tesseract termina cada página con '\f')
+INVALID_XML_CHARS = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+# Párrafo con un salto de página, entre una página y la siguiente
+PAGE_BREAK_XML = '<w:p><w:r><w:br w:type="page"/></w:r></w:p>'
+
+def page_xml(page_num, text):
+    """Genera el XML de Word de una página: título y un párrafo con una línea por
+    run (separadas con saltos de línea)."""
+    lines = INVALID_XML_CHARS.sub("", text).strip().splitlines()
+    runs = "<w:r><w:br/></w:r>".join(
+        f'<w:r><w:t xml:space="preserve">{escape(line)}</w:t></w:r>' for line in lines
+    )
+    return (
+        f'<w:p><w:pPr><w:pStyle w:val="Heading3"/></w:pPr><w:r><w:t>--- Página {page_num} ---</w:t></w:r></w:p>'
+        f'<w:p>{runs}</w:p>'
     )
-    
-    # Filtrar imágenes que no estaban en la lista (por si el rango no era contiguo)
-    # Esto es complejo, por simplicidad, vamos a procesar solo las imágenes devueltas
-    # que coincidan con el índice.
-    
-    # Nota: 'images' solo contendrá las imágenes del rango min-max.
-    # Si el usuario pidió 1, 5, obtendrá 1, 2, 3, 4, 5.
-    # Por ahora, procesaremos el rango continuo.
-    
-    st.warning("Nota de OCR: Se procesarán las páginas en el rango continuo de tu selección (ej: 1, 5 se procesa como 1-5).")
 
-    # 2. Crear un documento Word
-    doc = Document()
-    doc.add_heading(f"Documento Convertido por OCR ({lang_code})", 0)
-    
-    # 3. Procesar cada imagen con Tesseract
-    for i, img in enumerate(images):
-        page_num = i + min(pages_1_indexed)
-        
-        # Opcional: Mostrar progreso
-        st.text(f"Procesando página {page_num}...")
-        
-        # Extraer texto
-        text = pytesseract.image_to_string(img, lang=lang_code)
-        
-        # Añadir texto al doc
-        doc.add_heading(f"--- Página {page_num} ---", level=3)
-        doc.add_paragraph(text)
-        doc.add_page_break()
-
-    # 4. Guardar documento en memoria
+@st.cache_data(show_spinner=False, max_entries=8, ttl=3600)
+def ocr_texts(_pdf_path, pdf_hash, lang_code, pages_to_convert, skip_text=False):
+    """Usa Tesseract OCR para extraer el texto de las páginas (0-indexed).
+    Devuelve una lista de (página 1-indexed, texto) ordenada por página."""
+    # 1. Con 'skip_text', las páginas con texto embebido no se renderizan ni pasan por OCR
+    known_texts = embedded_texts(_pdf_path, pages_to_convert) if skip_text else {}
+
+    # El 'pages_to_convert' aquí es 0-indexed; el OCR trabaja con páginas 1-indexed
+    pages_1_indexed = [p + 1 for p in pages_to_convert if p + 1 not in known_texts]
+
+    # 2. Procesar el resto de páginas: con ocrmypdf si está instalado, si no (o si
+    #    falla) renderizando y aplicando Tesseract en paralelo
+    page_texts = None
+    if pages_1_indexed and ocrmypdf_ok:
+        try:
+            page_texts = ocr_pages_ocrmypdf(_pdf_path, lang_code, pages_1_indexed)
+        except Exception:
+            # Se repite con el OCR integrado, pero se deja constancia del fallo en el log
+            logging.getLogger(__name__).warning(
+                "ocrmypdf falló; se usa el OCR integrado", exc_info=True
+            )
+            page_texts = None
+    if page_texts is None:
+        page_texts = ocr_pages(_pdf_path, lang_code, pages_1_indexed) if pages_1_indexed else []
+    return sorted(page_texts + list(known_texts.items()))
+
+def convert_ocr(pdf_path, pdf_hash, lang_code, pages_to_convert, skip_text=False):
+    """Convierte las páginas con OCR a un documento Word (el OCR se cachea)."""
+    page_texts = ocr_texts(pdf_path, pdf_hash, lang_code, pages_to_convert, skip_text)
+
+    # Escribir el .docx directamente: el XML del cuerpo se arma como texto y se
+    # comprime con el nivel más rápido (el texto de OCR comprime bien igualmente)
+    title = escape(f"Documento Convertido por OCR ({lang_code})")
+    body_xml = f'<w:p><w:pPr><w:pStyle w:val="Title"/></w:pPr><w:r><w:t>{title}</w:t></w:r></w:p>'
+    body_xml += PAGE_BREAK_XML.join(page_xml(page_num, text) for page_num, text in page_texts)
+
+    docx_stream = io.BytesIO()
+    with zipfile.ZipFile(docx_stream, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as docx_zip:
+        docx_zip.writestr("[Content_Types].xml", DOCX_CONTENT_TYPES)
+        docx_zip.writestr("_rels/.rels", DOCX_RELS)
+        docx_zip.writestr("word/_rels/document.xml.rels", DOCX_DOCUMENT_RELS)
+        docx_zip.writestr("word/styles.xml", DOCX_STYLES)
+        docx_zip.writestr("word/document.xml", DOCX_DOCUMENT_HEAD + body_xml + DOCX_DOCUMENT_TAIL)
+    return docx_stream.getvalue()
+
+def element_sect_pr(element):
+    """Devuelve el sectPr de un elemento del cuerpo: el propio elemento si es el sectPr
+    final, el de su pPr si es un párrafo que cierra sección, o None."""
+    from docx.oxml.ns import qn
+
+    if element.tag == qn("w:sectPr"):
+        return element
+    if element.tag == qn("w:p"):
+        return element.find(f"{qn('w:pPr')}/{qn('w:sectPr')}")
+    return None
+
+def split_docx_pages(body):
+    """Separa el cuerpo de un .docx de pdf2docx en listas de elementos, una por página.
+    pdf2docx abre cada página con una sección de tipo 'nextPage'; dentro de una
+    página puede haber otras secciones (columnas) de tipo 'continuous'."""
+    from docx.oxml.ns import qn
+
+    pages = [[]]
+    section = []
+    for element in list(body):
+        section.append(element)
+        sect_pr = element_sect_pr(element)
+        if sect_pr is None:
+            continue
+        # El tipo de la sección indica cómo empieza: sin tipo equivale a 'nextPage'
+        start = sect_pr.find(qn("w:type"))
+        if (start is None or start.get(qn("w:val")) in ("nextPage", "oddPage", "evenPage")) and pages[-1]:
+            pages.append([])
+        pages[-1].extend(section)
+        section = []
+    return pages
+
+def convert_mixed(pdf_path, pdf_hash, lang_code, pages_to_convert):
+    """Convierte con pdf2docx las páginas que ya tienen texto y con OCR las escaneadas,
+    ambas a la vez, y las intercala en el orden original de las páginas."""
+    import copy
+    from docx import Document
+    from docx.oxml import OxmlElement, parse_xml
+    from docx.oxml.ns import nsdecls, qn
+
+    # Cualquier capa de texto, aunque sea corta (portadas, títulos, figuras con pie),
+    # va por pdf2docx: el OCR perdería las imágenes y el formato de la página
+    text_pages = embedded_texts(pdf_path, pages_to_convert, min_chars=0)
+    digital_pages = [p for p in pages_to_convert if p + 1 in text_pages]
+    image_pages = [p for p in pages_to_convert if p + 1 not in text_pages]
+    if not image_pages:
+        return convert_digital(pdf_path, pdf_hash, pages_to_convert)
+    if not digital_pages:
+        return convert_ocr(pdf_path, pdf_hash, lang_code, pages_to_convert)
+
+    # Una sola conversión de cada tipo, a la vez: pdf2docx trabaja en procesos y el
+    # OCR en hilos nativos, así que no compiten entre sí. El hilo de OCR hereda el
+    # contexto de Streamlit para poder usar la caché.
+    ctx = get_script_run_ctx()
+    with ThreadPoolExecutor(max_workers=1, initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx)) as executor:
+        ocr_future = executor.submit(ocr_texts, pdf_path, pdf_hash, lang_code, image_pages)
+        digital_bytes = convert_digital(pdf_path, pdf_hash, digital_pages)
+        page_texts = dict(ocr_future.result())
+
+    # El documento de pdf2docx es la base: se parte por páginas y se vuelve a
+    # montar intercalando las páginas de OCR
+    doc = Document(io.BytesIO(digital_bytes))
+    body = doc.element.body
+    digital_elements = split_docx_pages(body)
+    if len(digital_elements) != len(digital_pages):
+        raise RuntimeError(f"pdf2docx devolvió {len(digital_elements)} páginas de {len(digital_pages)}.")
+    digital_elements = dict(zip(digital_pages, digital_elements))
+    for element in list(body):
+        body.remove(element)
+
+    last_sect_pr = None
+    for i, p in enumerate(pages_to_convert):
+        is_last = i == len(pages_to_convert) - 1
+        if p in digital_elements:
+            elements = digital_elements[p]
+            last_sect_pr = element_sect_pr(elements[-1])
+            if elements[-1].tag == qn("w:sectPr") and not is_last:
+                # El sectPr final del cuerpo pasa a un párrafo (salto de sección)
+                paragraph = OxmlElement("w:p")
+                p_pr = OxmlElement("w:pPr")
+                p_pr.append(elements[-1])
+                paragraph.append(p_pr)
+                elements[-1] = paragraph
+            body.extend(elements)
+        else:
+            xml = page_xml(p + 1, page_texts[p + 1]) + ("" if is_last else PAGE_BREAK_XML)
+            body.extend(list(parse_xml(f"<w:body {nsdecls('w')}>{xml}</w:body>")))
+            if is_last:
+                # La última sección del documento toma el formato de la última página digital
+                sect_pr = copy.deepcopy(last_sect_pr)
+                start = sect_pr.find(qn("w:type"))
+                if start is not None:
+                    sect_pr.remove(start)
+                body.append(sect_pr)
+
     docx_stream = io.BytesIO()
     doc.save(docx_stream)
     return docx_stream.getvalue()
 
+def count_pages(pdf_path):
+    """Cuenta las páginas sin renderizar nada. pypdf solo lee la tabla xref; si no
+    puede leer el archivo, se recurre a 'pdfinfo' de Poppler, más tolerante con PDFs dañados."""
+    try:
+        return len(PdfReader(pdf_path).pages)
+    except Exception:
+        if not poppler_ok:
+            raise
+        from pdf2image import pdfinfo_from_path
+        return pdfinfo_from_path(pdf_path)["Pages"]
+
+# Edad (en segundos) a partir de la cual una copia sin usar de un PDF subido se
+# considera abandonada (sesión cerrada)
+UPLOAD_MAX_AGE = 2 * 3600
+
+@st.cache_resource
+def upload_dir():
+    """Carpeta para las copias de los PDFs subidos, creada una vez por proceso con
+    mkdtemp: nombre impredecible y permisos solo para el usuario que ejecuta la app."""
+    return tempfile.mkdtemp(prefix="transformarpdf_")
+
+def sweep_uploads():
+    """Borra las copias de PDFs que nadie ha usado en UPLOAD_MAX_AGE segundos."""
+    limit = time.time() - UPLOAD_MAX_AGE
+    for entry in os.scandir(upload_dir()):
+        try:
+            if entry.stat().st_mtime < limit:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            pass  # Otra sesión la borró antes
+
+def discard_upload():
+    """Borra la copia del PDF de esta sesión (p. ej. cuando el usuario quita el archivo)."""
+    saved = st.session_state.pop("pdf_upload", None)
+    if saved and os.path.exists(saved["path"]):
+        os.remove(saved["path"])
+
+def save_upload(uploaded_file):
+    """Copia el PDF subido a un archivo temporal por bloques, calculando su hash.
+    Devuelve (ruta, hash). La copia se reutiliza en los reruns mientras no cambie el archivo."""
+    saved = st.session_state.get("pdf_upload")
+    if saved and saved["file_id"] == uploaded_file.file_id and os.path.exists(saved["path"]):
+        os.utime(saved["path"])  # Sigue en uso: que no la borre el barrido
+        return saved["path"], saved["hash"]
+    discard_upload()  # El archivo anterior ya no se usa
+
+    if not os.path.isdir(upload_dir()):
+        upload_dir.clear()  # La borró un limpiador de /tmp: se crea otra
+    sweep_uploads()
+
+    sha256 = hashlib.sha256()
+    uploaded_file.seek(0)
+    with tempfile.NamedTemporaryFile(suffix=".pdf", dir=upload_dir(), delete=False) as tmp:
+        for block in iter(lambda: uploaded_file.read(1024 * 1024), b""):
+            sha256.update(block)
+            tmp.write(block)
+
+    saved = {"file_id": uploaded_file.file_id, "path": tmp.name, "hash": sha256.hexdigest()}
+    st.session_state["pdf_upload"] = saved
+    return saved["path"], saved["hash"]
+
 # --- 4. Lógica Principal de la App ---
 
 uploaded_file = st.file_uploader("Elige un archivo PDF", type="pdf")
 
 if uploaded_file is not None:
     
-    # Obtener el número de páginas (requiere Poppler)
+    # El PDF se guarda en disco: pdf2docx, PDFium y pypdf lo leen por ruta
+    # sin mantener copias adicionales en memoria
+    pdf_path, pdf_hash = save_upload(uploaded_file)
+
+    # Obtener el número de páginas. Sin él no se puede validar el rango,
+    # así que la conversión queda deshabilitada.
     max_pages = 0
-    if poppler_ok:
-        try:
-            # Una forma rápida de contar páginas
-            images_info = convert_from_bytes(uploaded_file.getvalue(), fmt='jpeg', first_page=1, last_page=1)
-            # Truco: pdf2image no tiene un 'count' directo, así que leemos una página
-            # para probar. Un método más robusto usaría PyPDF2.
-            st.info("Pre-chequeo de PDF... (usando PyPDF2 para contar páginas sería más robusto)")
-            # Vamos a simplificar: no contaremos páginas por ahora
-            # max_pages = 100 # Asumir un max
-            st.warning("Conteo de páginas no implementado. Introduce el rango manualmente.")
-            max_pages = 500 # Un límite arbitrario alto
-        except Exception as e:
-            st.error(f"No se pudo pre-procesar el PDF: {e}")
-            
+    try:
+        max_pages = count_pages(pdf_path)
+        st.info(f"El PDF tiene {max_pages} páginas.")
+    except Exception as e:
+        st.error(f"No se pudo leer el PDF (¿archivo dañado o protegido?): {e}")
+
     # Opciones de páginas
     page_range_str = st.text_input(
-        "Rango de páginas a convertir (ej: 1, 3-5, 9). Deja en blanco para TODAS.",
+        f"Rango de páginas a convertir (ej: 1, 3-5, 9; máximo {max_pages}). Deja en blanco para TODAS.",
         placeholder="Ej: 1-3, 5"
     )
 
-    if st.button("Convertir a Word", type="primary"):
+    if st.button("Convertir a Word", type="primary", disabled=max_pages == 0):
         with st.spinner("Procesando... El modo OCR puede ser muy lento..."):
             try:
-                # Cargar bytes del archivo
-                pdf_bytes = uploaded_file.getvalue()
-                
                 # Decidir qué páginas procesar
-                # Nota: Necesitamos una forma de saber el máx de páginas
-                # Por ahora, usamos un límite alto y confiamos en el usuario.
-                # Una versión 3.0 usaría PyPDF2 para un conteo exacto.
-                pages_list = parse_page_range(page_range_str, max_pages=500)
+                pages_list = parse_page_range(page_range_str, max_pages)
                 
                 if not pages_list:
                     st.error("Rango de páginas no válido o vacío.")
@@ -208,11 +783,15 @@ if uploaded_file is not None:
                     # --- Selección de MODO ---
                     if "Digital" in modo_conversion:
                         st.info("Iniciando conversión digital...")
-                        docx_bytes = convert_digital(pdf_bytes, pages_list)
+                        docx_bytes = convert_digital(pdf_path, pdf_hash, pages_list)
                     
                     elif "Escaneado" in modo_conversion:
-                        st.info("Iniciando conversión OCR...")
-                        docx_bytes = convert_ocr(pdf_bytes, lang, pages_list)
+                        st.info(f"Iniciando conversión OCR en idioma: {lang}. Esto tomará un momento...")
+                        docx_bytes = convert_ocr(pdf_path, pdf_hash, lang, pages_list, skip_text)
+
+                    elif "Mixto" in modo_conversion:
+                        st.info(f"Iniciando conversión mixta (digital + OCR en idioma: {lang})...")
+                        docx_bytes = convert_mixed(pdf_path, pdf_hash, lang, pages_list)
                     
                     st.success("¡Conversión exitosa!")
                     
@@ -233,4 +812,5 @@ if uploaded_file is not None:
                     st.error("Error de Poppler: Asegúrate de que esté instalado Y en el PATH del sistema.")
 
 else:
+    discard_upload()
     st.info("Por favor, sube un archivo PDF para comenzar.")
@@ -0,0 +1,23 @@
+"""Conversión de un grupo de páginas con pdf2docx en un proceso aparte.
+
+app.py lo lanza como script (un proceso por grupo de páginas) para repartir
+pdf2docx entre núcleos sin usar 'fork' sobre el servidor de Streamlit:
+
+    python converters.py ENTRADA.pdf SALIDA.docx 0,1,2
+"""
+import sys
+
+
+def convert_digital_chunk(pdf_path, docx_file, pages):
+    """Convierte las páginas indicadas (0-indexed) con pdf2docx.
+    'docx_file' puede ser una ruta o un stream."""
+    from pdf2docx import Converter
+
+    cv = Converter(pdf_path)
+    cv.convert(docx_file, pages=pages)
+    cv.close()
+
+
+if __name__ == "__main__":
+    pdf_path, docx_path, pages = sys.argv[1:4]
+    convert_digital_chunk(pdf_path, docx_path, [int(p) for p in pages.split(",")])